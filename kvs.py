@@ -4,6 +4,86 @@ import json
 import time
 from filelock import Timeout, FileLock
 import random
+import os
+import math
+import weakref
+import pathlib
+from collections import OrderedDict
+
+# Compact separators so that no whitespace is stored with the values
+# Non-ASCII characters are stored as they are, the same way orjson stores them
+_json_encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+_json_ascii_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def _json_dumps(value):
+    """
+    :param value: A JSON object
+    :return: The value serialized by the json module and its size in UTF-8 bytes
+    """
+    string_value = _json_encode(value)
+    if string_value.isascii():
+        return string_value, len(string_value)
+    try:
+        return string_value, len(string_value.encode('utf-8'))
+    except UnicodeEncodeError:
+        # Lone surrogates can't be stored as UTF-8, so they are escaped
+        string_value = _json_ascii_encode(value)
+        return string_value, len(string_value)
+
+
+# orjson is optional, when it is installed it is used to (de)serialize the values as it is much faster
+# It falls back to json for the values which orjson would store differently, NaN, Infinity and integers beyond 64 bits
+# Unlike json, orjson also accepts some other types, for example UUIDs, enums and numpy arrays
+try:
+    import orjson
+
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def _has_non_finite(value):
+        """
+        :param value: A JSON object
+        :return: True if the value contains NaN or Infinity anywhere
+        """
+        if isinstance(value, float):
+            return not math.isfinite(value)
+        if isinstance(value, dict):
+            return any(_has_non_finite(k) or _has_non_finite(v) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return any(_has_non_finite(item) for item in value)
+        return False
+
+    def _dumps(value):
+        """
+        :param value: A JSON object
+        :return: The value serialized as bytes (by orjson) or a string (by json) and its size in UTF-8 bytes
+        """
+        try:
+            data = orjson.dumps(value, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # For example integers beyond 64 bits, or types which json rejects anyway
+            return _json_dumps(value)
+
+        # orjson turns NaN and Infinity into null, the value is only walked when its output has a null at all
+        if b'null' in data and _has_non_finite(value):
+            return _json_dumps(value)
+
+        # Stored as a BLOB, which tells _loads() that orjson wrote it
+        return data, len(data)
+
+    def _loads(stored_value):
+        """
+        :param stored_value: A value serialized by _dumps()
+        :return: The JSON object
+        """
+        # Bytes were written by orjson so they can only hold what orjson parses back unchanged
+        # Strings were written by json, possibly with NaN or integers beyond 64 bits, so json parses them
+        if isinstance(stored_value, bytes):
+            return orjson.loads(stored_value)
+        return json.loads(stored_value)
+except ImportError:
+    _dumps = _json_dumps
+    _loads = json.loads
 
 
 class KeyValueStore:
@@ -12,76 +92,112 @@ class KeyValueStore:
     _DB_SIZE_LIMIT = 1024 * 1024 * 1024  # Bytes
     _KEY_SIZE_LIMIT = 32  # Chars
     _VALUE_SIZE_LIMIT = 16 * 1024  # Bytes
-    _MAX_UNCOMMITTED_TRANSACTIONS_ALLOWED = 10000
-    _MAX_UNCOMMITTED_SIZE_ALLOWED = 15 * 1024 * 1024  # Bytes
-    _PERIODIC_COMMIT_TIME = 2 * 60  # Seconds
-
-    _all_objects = {}
+    _INSERT_SQL = "INSERT INTO key_value_store VALUES (?, ?, ?, ?)"
+    _KEY_SIZE_ERROR = f'Size of key must not be more than {_KEY_SIZE_LIMIT} chars'
+    _VALUE_SIZE_ERROR = f'Size of the value must not more than {_VALUE_SIZE_LIMIT} bytes'
+    _PERIODIC_MAINTENANCE_TIME = 2 * 60  # Seconds
+    _CHECKPOINT_EVERY_N_RUNS = 5  # Periodic maintenance runs between two WAL checkpoints
+    _DB_SIZE_CHECK_INTERVAL = 1000  # Inserts after which the size of the database is measured again
+    _DB_SIZE_CHECK_MARGIN = 1024 * 1024  # Bytes
+    _ROW_SIZE_OVERHEAD = 64  # Bytes, estimated space taken by a row apart from its key and value
+    _READ_CACHE_MAX = 4096  # Number of recently read values kept in memory
+
+    _all_objects = weakref.WeakValueDictionary()
 
     _class_lock = threading.Lock()
 
-    def __init__(self, conn, system_lock):
+    def __init__(self, conn, system_lock, file_address=None):
         """
         :param conn: The connection to the sqlite database
         :param system_lock: A FileLock object to the lock file of the database file
+        :param file_address: The normalized address of the database file
 
         Note: Users must never use this to initialize the objects.
         Use KeyValueStore.open() to initialize the objects.
 
         - Initializes some variables
-        - Starts the periodic commit thread
+        - Starts the periodic maintenance thread
+        - Registers the cleanup which runs when the object is closed or garbage collected
         """
         self._conn = conn
         self._lock = threading.Lock()
         self._system_lock = system_lock
-        self._uncommitted_transactions = 0
-        self._uncommitted_size = 0
-
-        # Start the thread to periodically commit
-        periodic_commit_thread = threading.Thread(target=self._periodic_commit)
-        periodic_commit_thread.start()
-        # Start the thread to periodically delete expired keys
-        periodic_check_for_ttl = threading.Thread(target=self._periodic_check_all_for_ttl)
-        periodic_check_for_ttl.start()
-
-    def __del__(self):
+        self._file_address = file_address
+        self._maintenance_runs = 0
+        self._stop = threading.Event()  # Set to stop the periodic maintenance thread
+
+        # The page size never changes, the used pages are only counted once in a while
+        self._page_size = conn.execute('PRAGMA PAGE_SIZE').fetchone()[0]
+        self._measured_db_size = self._db_size()
+        self._bytes_added = 0  # Estimated bytes inserted since the size was measured
+        self._inserts_since_measured = 0
+
+        # Recently read keys mapped to (serialized value, expiry time)
+        self._read_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0  # Incremented whenever a key is deleted
+
+        # Every thread reads through its own read-only connection, so that WAL only lets it see committed data
+        # The writes go through conn, which is shared by all the threads and guarded by self._lock
+        database_address = conn.execute('PRAGMA database_list').fetchone()[2]
+        self._read_uri = pathlib.Path(database_address).as_uri() + '?mode=ro'
+        self._thread_data = threading.local()
+        self._read_connections = weakref.WeakSet()  # Only alive as long as the thread which uses it
+
+        # Start the thread to periodically delete expired keys and checkpoint the WAL
+        # It only holds a weak reference so that it doesn't keep the object alive
+        periodic_maintenance_thread = threading.Thread(target=KeyValueStore._run_periodic_maintenance,
+                                                       args=(weakref.ref(self), self._stop), daemon=True)
+        periodic_maintenance_thread.start()
+
+        # Must not reference self, otherwise the object would never be garbage collected
+        self._finalizer = weakref.finalize(self, KeyValueStore._cleanup, conn, system_lock, self._lock, self._stop,
+                                           self._read_connections)
+
+    def close(self):
         """
-        Destructor
-        - Commits any uncommitted transactions and closes the connection to the database
+        :return: Void
+        - Stops the periodic maintenance thread
+        - Closes the connection to the database
         - Releases the system level lock for the database file
+
+        The object must not be used after it is closed, use KeyValueStore.open() to open the file again
+        It is also closed automatically when it is garbage collected or the interpreter exits
         """
-        if self._conn:
-            self._conn.commit()
-            self._conn.close()
-        if self._system_lock:
-            self._system_lock.release()
+        with KeyValueStore._class_lock:
+            if KeyValueStore._all_objects.get(self._file_address) is self:
+                del KeyValueStore._all_objects[self._file_address]
+        self._finalizer()
 
     @classmethod
-    def open(cls, file_name, file_directory=None):
+    def open(cls, file_name, file_directory=None, lock_timeout=1.0, lock_poll=0.005):
         """
         :param file_name: A string for the name of the file
         :param file_directory: A string describing the directory where the file resides
             or must reside in case if the file doesn't exist
+        :param lock_timeout: Seconds to wait for another process to release the file
+        :param lock_poll: Seconds between two attempts to acquire the file
         :return: A KeyValueStore Object
 
         If file_address is not provided, the file will be created at the DEFAULT_DIRECTORY
 
         """
-        # Generate the file address
-        if file_directory:
-            file_address = file_directory + file_name
-        else:
-            file_address = cls._DEFAULT_DIRECTORY + file_name
+        # Generate the file address, normalized so that every path to the same file maps to the same object
+        file_address = os.path.join(file_directory or cls._DEFAULT_DIRECTORY, file_name)
+        file_address = os.path.abspath(os.path.realpath(file_address))
 
         # Get the class lock
         with cls._class_lock:
 
             # See if an object already exists which is connected to this database
-            if file_address in cls._all_objects:
-                return cls._all_objects[file_address]
+            existing_obj = cls._all_objects.get(file_address)
+            if existing_obj is not None:
+                return existing_obj
 
             # Check if the database exists and create one if it doesn't
-            conn = sqlite3.connect(file_address, check_same_thread=False)
+            # Every statement commits on its own unless a transaction is begun explicitly
+            conn = sqlite3.connect(file_address, check_same_thread=False, isolation_level=None)
+            cls._configure_connection(conn)
 
             # Create table if doesn't exist
             cls._create_table(conn)
@@ -90,12 +206,14 @@ class KeyValueStore:
             lock_address = file_address + '.lock'
             system_lock = FileLock(lock_address)
             try:
-                system_lock.acquire(timeout=1)
+                # The poll interval is passed positionally as its keyword differs between filelock versions
+                system_lock.acquire(lock_timeout, lock_poll)
             except Timeout:
+                conn.close()
                 raise Exception("Some other process is already accessing the desired file", 100)
 
             # Create the object
-            new_obj = KeyValueStore(conn, system_lock)
+            new_obj = KeyValueStore(conn, system_lock, file_address)
             cls._all_objects[file_address] = new_obj
 
             return new_obj
@@ -107,40 +225,66 @@ class KeyValueStore:
         :param ttl: An integer defining the Time To Live in seconds. -1 means infinite
         :return: Void
         """
-        key_len = len(key)
-        string_value = json.dumps(value)
-        value_len = len(string_value)
-
-        # Check if the key is oversized
-        if key_len > KeyValueStore._KEY_SIZE_LIMIT:
-            raise Exception('Size of key must not be more than ' + str(KeyValueStore._KEY_SIZE_LIMIT) + ' chars', 101)
+        string_value = self._dump_value(key, value)
 
-        # Check if the value is oversized
-        if value_len >= KeyValueStore._VALUE_SIZE_LIMIT:
-            raise Exception('Size of the value must not more than ' + str(KeyValueStore._VALUE_SIZE_LIMIT) + ' bytes',
-                            102)
+        self._maybe_expire(key)
 
-        self._check_for_ttl(key)
-        cursor = self._conn.cursor()
+        # Prepare everything before taking the lock so that it is held as briefly as possible
+        params = (key, string_value, time.time(), ttl)
+        row_size = len(key) + len(string_value)
 
         # Get lock
         with self._lock:
 
-            # Check if the key already exists
-            result = cursor.execute(f"SELECT * FROM key_value_store WHERE key = '{key}'").fetchone()
-            if result:
-                raise Exception("The given key already exists", 201)
-
             # Check if the database has already exceeded the _DB_SIZE_LIMIT
             if self._is_db_oversized():
                 raise Exception("Can't store any more keys because file is already at its maximum capacity", 103)
 
-            # Put the key in the database
-            cursor.execute(f"INSERT INTO key_value_store \
-                VALUES ('{key}', '{string_value}', '{time.time()}', '{ttl}')")
+            # Put the key in the database, the primary key rejects it if it already exists
+            try:
+                self._conn.execute(KeyValueStore._INSERT_SQL, params)
+            except sqlite3.IntegrityError:
+                raise Exception("The given key already exists", 201)
+
+            self._bytes_added += row_size + KeyValueStore._ROW_SIZE_OVERHEAD
+            self._inserts_since_measured += 1
 
-        self._uncommitted_size += key_len + value_len
-        self._commit()
+        self._forget(key, deleted=False)
+
+    def create_many(self, items, ttl=-1):
+        """
+        :param items: An iterable of (key, value) pairs where each key and value follow the same limits as in create()
+        :param ttl: An integer defining the Time To Live in seconds for all the keys. -1 means infinite
+        :return: Void
+
+        Creates all the given keys in a single transaction
+        Either all the keys are created or, if any of them already exists, none of them are
+        """
+        timestamp = time.time()
+        rows = [(key, self._dump_value(key, value), timestamp, ttl) for key, value in items]
+        batch_size = sum(len(row[0]) + len(row[1]) + KeyValueStore._ROW_SIZE_OVERHEAD for row in rows)
+
+        with self._lock:
+
+            # Check if the whole batch fits within the _DB_SIZE_LIMIT
+            if self._is_db_oversized(batch_size):
+                raise Exception("Can't store any more keys because file is already at its maximum capacity", 103)
+
+            # The connection commits the batch if all the inserts succeed and rolls it back otherwise
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                with self._conn:
+                    # Expired keys must not collide with the new ones
+                    self._check_all_for_ttl()
+                    self._conn.executemany(KeyValueStore._INSERT_SQL, rows)
+            except sqlite3.IntegrityError:
+                raise Exception("The given key already exists", 201)
+            finally:
+                # Reads only see committed rows, so no read in flight can cache a value from a rolled back batch
+                self._forget(*(row[0] for row in rows), deleted=False)
+
+            self._bytes_added += batch_size
+            self._inserts_since_measured += len(rows)
 
     def read(self, key):
         """
@@ -148,18 +292,40 @@ class KeyValueStore:
         :return: A JSON object which is the value of the given key in the store
         """
 
-        self._check_for_ttl(key)
+        # Serve the value from the cache if it is there and not expired
+        with self._cache_lock:
+            cached = self._read_cache.get(key)
+            if cached and time.time() <= cached[1]:
+                self._read_cache.move_to_end(key)
+            else:
+                cached = None
+            generation = self._cache_generation
+        if cached:
+            return _loads(cached[0])
 
-        # Get the record from the database
-        cursor = self._conn.cursor()
-        record = cursor.execute(f"SELECT * FROM key_value_store WHERE key = '{key}'").fetchone()
+        # Get the record from the database without taking the lock
+        # The thread's own connection only sees committed data, so an open create_many batch is not visible
+        record = self._read_conn().execute("SELECT value, timestamp, ttl FROM key_value_store WHERE key = ?",
+                                           (key,)).fetchone()
 
-        # If the given key doesn't exist
+        # If the given key doesn't exist or has expired
         if not record:
             raise Exception("The given key does not exist", 202)
+        string_value, timestamp, ttl = record
+        now = time.time()
+        if KeyValueStore._is_expired(timestamp, ttl, now):
+            self._delete_expired(key, now)
+            raise Exception("The given key does not exist", 202)
+
+        with self._cache_lock:
+            # Don't cache the value if some key was deleted meanwhile, it may have been this one
+            if generation == self._cache_generation:
+                self._read_cache[key] = (string_value, math.inf if ttl == -1 else timestamp + ttl)
+                if len(self._read_cache) > KeyValueStore._READ_CACHE_MAX:
+                    self._read_cache.popitem(last=False)
 
         # Return the JSON value corresponding to the key
-        return json.loads(record[1])
+        return _loads(string_value)
 
     def delete(self, key):
         """
@@ -167,21 +333,17 @@ class KeyValueStore:
         :return: Void
         """
 
-        self._check_for_ttl(key)
-        cursor = self._conn.cursor()
+        self._maybe_expire(key)
 
         with self._lock:
-            # Get the record from the database
-            record = cursor.execute(f"SELECT * FROM key_value_store WHERE key = '{key}'").fetchone()
+            # Delete the record
+            cursor = self._conn.execute("DELETE FROM key_value_store WHERE key = ?", (key,))
 
             # If there is no value with the given key
-            if not record:
+            if cursor.rowcount == 0:
                 raise Exception("The given  key does not exist", 202)
 
-            # Delete the record
-            cursor.execute(f"DELETE FROM key_value_store WHERE key = '{key}'")
-
-        self._commit()
+            self._forget(key)
 
     def optimize_file(self):
         """
@@ -190,8 +352,42 @@ class KeyValueStore:
         It is a heavy operation and no queries will be processed until it is finished
         """
         with self._lock:
-            self._conn.commit()  # Must commit otherwise vacuum won't work
-            self._conn.execute(f"VACUUM")  # Rebuilds the database
+            self._conn.execute("VACUUM")  # Rebuilds the database
+
+    @classmethod
+    def _dump_value(cls, key, value):
+        """
+        :param key: A string for the key
+        :param value: A JSON object
+        :return: The serialized value
+
+        Raises an exception if either the key or the serialized value is oversized
+        """
+        # Check if the key is oversized
+        if len(key) > cls._KEY_SIZE_LIMIT:
+            raise Exception(cls._KEY_SIZE_ERROR, 101)
+
+        # Check if the value is oversized
+        string_value, value_size = _dumps(value)
+        if value_size >= cls._VALUE_SIZE_LIMIT:
+            raise Exception(cls._VALUE_SIZE_ERROR, 102)
+
+        return string_value
+
+    @classmethod
+    def _configure_connection(cls, conn):
+        """
+        :param conn: Connection to the database
+        :return: Void
+        Switches the database to WAL mode so that reads don't block on writes
+        and tunes the connection for a write heavy workload
+        """
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # Safe in WAL mode, only syncs on checkpoints
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")  # KiB
+        conn.execute("PRAGMA mmap_size=268435456")  # Bytes
+        conn.execute("PRAGMA busy_timeout=5000")  # Milliseconds
 
     @classmethod
     def _create_table(cls, conn):
@@ -199,6 +395,7 @@ class KeyValueStore:
         :param conn: Connection to the database
         :return: Void
         Creates the table which is to be used to store the key value store
+        along with an index on the expiry time of the keys which have a ttl
         Only creates if the table doesn't exist, otherwise has not effect
         """
         cursor = conn.cursor()
@@ -210,90 +407,189 @@ class KeyValueStore:
             ttl INTEGER
         ) 
         """)
-        conn.commit()
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS key_value_store_expiry
+        ON key_value_store (timestamp + ttl) WHERE ttl != -1
+        """)
 
     def _db_size(self):
         """
         :return: The size (in bytes) of the database that this object is connected to
         """
-        page_count = self._conn.execute('PRAGMA PAGE_COUNT').fetchone()[0]
-        free_page_count = self._conn.execute('PRAGMA FREELIST_COUNT').fetchone()[0]
-        page_size = self._conn.execute('PRAGMA PAGE_SIZE').fetchone()[0]
-
         # Only used pages should be counted to calculate the size
-        return (page_count - free_page_count) * page_size
+        used_pages = self._conn.execute("SELECT p.page_count - f.freelist_count \
+                                         FROM pragma_page_count AS p, pragma_freelist_count AS f").fetchone()[0]
+        return used_pages * self._page_size
 
-    def _is_db_oversized(self):
+    def _measure_db_size(self):
         """
-        :return: Boolean
+        :return: The size (in bytes) of the database
+        Measures the size of the database and resets the estimate of the bytes added since the last measurement
+        """
+        self._measured_db_size = self._db_size()
+        self._bytes_added = 0
+        self._inserts_since_measured = 0
+        return self._measured_db_size
+
+    def _is_db_oversized(self, incoming_size=0):
+        """
+        :param incoming_size: Estimated bytes which are about to be inserted
+        :return: Boolean, whether the database would reach the _DB_SIZE_LIMIT with the incoming bytes
+
+        Note: The calling method must take care of lock
         """
+        # Measuring the database is costly, so trust the estimate while it is far enough from the limit
+        pending_size = self._bytes_added + incoming_size
+        estimated_size = self._measured_db_size + pending_size
+        if self._inserts_since_measured < KeyValueStore._DB_SIZE_CHECK_INTERVAL \
+                and pending_size < KeyValueStore._DB_SIZE_CHECK_MARGIN \
+                and estimated_size < self._DB_SIZE_LIMIT - KeyValueStore._DB_SIZE_CHECK_MARGIN:
+            return False
+
         # Check if the database has already exceeded the _DB_SIZE_LIMIT
-        if self._db_size() >= self._DB_SIZE_LIMIT:
+        if self._measure_db_size() + incoming_size >= self._DB_SIZE_LIMIT:
 
             # See if there are any expired keys present
             self._check_all_for_ttl()
 
             # See if the database size decreased
-            if self._db_size() >= self._DB_SIZE_LIMIT:
+            if self._measure_db_size() + incoming_size >= self._DB_SIZE_LIMIT:
+                # Flush the WAL so that the file on disk reflects the full database
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
                 return True
 
         return False
 
-    def _commit(self):
+    @staticmethod
+    def _cleanup(conn, system_lock, lock, stop, read_connections):
         """
+        :param conn: The connection to the database
+        :param system_lock: The FileLock of the database file
+        :param lock: The lock of the object
+        :param stop: The Event which stops the periodic maintenance thread
+        :param read_connections: The _ReadConnection objects of the threads which are still alive
+        :return: Void
+        Runs only once per object, either from close() or when the object is garbage collected
+        """
+        stop.set()
+        with lock:
+            conn.close()
+        for read_connection in list(read_connections):
+            read_connection.conn.close()
+        system_lock.release()
+
+    def _read_conn(self):
+        """
+        :return: The read-only connection to the database of the calling thread
+        Unlike the shared connection, it never sees the changes of a transaction which is still open
+        """
+        read_connection = getattr(self._thread_data, 'read_connection', None)
+        if read_connection is None:
+            conn = sqlite3.connect(self._read_uri, uri=True, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=5000")  # Milliseconds
+            conn.execute("PRAGMA mmap_size=268435456")  # Bytes
+            read_connection = _ReadConnection(conn)
+            self._thread_data.read_connection = read_connection
+            self._read_connections.add(read_connection)
+        return read_connection.conn
+
+    @staticmethod
+    def _run_periodic_maintenance(store_ref, stop):
+        """
+        :param store_ref: A weak reference to the KeyValueStore object
+        :param stop: The Event which is set when the object is closed
         :return: Void
-        Commits the transactions if
-            - number of uncommitted transactions has reached the limit, or
-            - size of uncommitted transactions has reached the limit
+        Keep calling _periodic_maintenance() until the object is closed or garbage collected
         """
-        self._uncommitted_transactions += 1
-        if self._uncommitted_transactions >= KeyValueStore._MAX_UNCOMMITTED_TRANSACTIONS_ALLOWED\
-                or self._uncommitted_size >= KeyValueStore._MAX_UNCOMMITTED_SIZE_ALLOWED:
+        # Sleep for some random time
+        while not stop.wait(timeout=KeyValueStore._periodic_sleep_time()):
+            store = store_ref()
+            if store is None:
+                return
+            store._periodic_maintenance()
+            del store
 
-            with self._lock:
-                self._conn.commit()
+    def _periodic_maintenance(self):
+        """
+        :return: Void
+        Deletes the expired keys and, every few runs, checkpoints the WAL
+        """
+        with self._lock:
+            # The connection may have been closed while waiting for the lock
+            if self._stop.is_set():
+                return
 
-                self._uncommitted_transactions = 0
-                self._uncommitted_size = 0
+            self._check_all_for_ttl()
+
+            # Every few runs, move the WAL back into the database so it doesn't keep growing
+            self._maintenance_runs += 1
+            if self._maintenance_runs >= KeyValueStore._CHECKPOINT_EVERY_N_RUNS:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._conn.execute("PRAGMA optimize")
+                self._maintenance_runs = 0
 
-    def _periodic_commit(self):
+    @classmethod
+    def _periodic_sleep_time(cls):
         """
-        :return:
-        Commits all the transactions before every _PERIODIC_COMMIT_TIME seconds
+        :return: A random number of seconds between half of and the full _PERIODIC_MAINTENANCE_TIME
         """
-        while True:
-            with self._lock:
-                self._conn.commit()
+        half = int(cls._PERIODIC_MAINTENANCE_TIME / 2)
+        return half + random.randrange(0, half)
 
-            # Sleep for some random time
-            time.sleep(KeyValueStore._PERIODIC_COMMIT_TIME/2
-                       + random.randrange(0, KeyValueStore._PERIODIC_COMMIT_TIME/2))
-
-    def _check_for_ttl(self, key):
+    def _maybe_expire(self, key):
         """
         :param key: A string for the key
         :return: Void
         If the given key exists and is expired, it is deleted
+        The key is looked up through the thread's own connection and the lock is only taken if it has to be deleted
+        """
+        # Get the committed record from the database
+        record = self._read_conn().execute("SELECT timestamp, ttl FROM key_value_store WHERE key = ?",
+                                           (key,)).fetchone()
+        now = time.time()
+
+        if record and KeyValueStore._is_expired(record[0], record[1], now):
+            self._delete_expired(key, now)
+
+    def _delete_expired(self, key, now):
+        """
+        :param key: A string for the key
+        :param now: The time against which the expiry is checked
+        :return: Void
+        Deletes the given key if it is expired at the given time
         """
-        # Get the lock
         with self._lock:
-            # Get the record from the database
-            self._conn.execute(f"DELETE FROM key_value_store \
-                                       WHERE key='{key}' \
-                                       AND ttl != -1 \
-                                       AND {time.time()} - timestamp > ttl")
+            # The key may have been replaced meanwhile, so check the expiry again while deleting
+            cursor = self._conn.execute("DELETE FROM key_value_store \
+                                         WHERE key = ? \
+                                         AND ttl != -1 \
+                                         AND ? - timestamp > ttl", (key, now))
+            if cursor.rowcount:
+                self._forget(key)
 
-    def _periodic_check_all_for_ttl(self):
+    @staticmethod
+    def _is_expired(timestamp, ttl, now):
+        """
+        :return: Boolean, whether a key stored at timestamp with the given ttl has expired at the time now
         """
+        return ttl != -1 and now - timestamp > ttl
+
+    def _forget(self, *keys, deleted=True):
+        """
+        :param keys: Strings for the keys
+        :param deleted: Whether the keys were deleted, as opposed to created
         :return: Void
-        Keep calling check_all_for_tll() periodically
+        Removes the given keys from the read cache
+        Must be called after the keys are changed in the database
+
+        Reads which are in flight stop caching only if keys were deleted, as they may have read the old values
+        A read can't have seen a created key before it was committed, so creating keys doesn't affect them
         """
-        while True:
-            # Sleep for some random time
-            time.sleep(KeyValueStore._PERIODIC_COMMIT_TIME / 2
-                       + random.randrange(0, KeyValueStore._PERIODIC_COMMIT_TIME / 2))
-            with self._lock:
-                self._check_all_for_ttl()
+        with self._cache_lock:
+            for key in keys:
+                self._read_cache.pop(key, None)
+            if deleted:
+                self._cache_generation += 1
 
     def _check_all_for_ttl(self):
         """
@@ -301,10 +597,10 @@ class KeyValueStore:
 
         Note: The calling method must take care of lock
         """
-        # Delete teh expired keys
-        self._conn.execute(f"DELETE FROM key_value_store \
-                                        WHERE ttl != -1 \
-                                        AND {time.time()} - timestamp > ttl")
+        # Delete the expired keys, the conditions match key_value_store_expiry so only expired rows are visited
+        self._conn.execute("DELETE FROM key_value_store \
+                            WHERE ttl != -1 \
+                            AND timestamp + ttl < ?", (time.time(),))
 
     def _debug_print_all_keys(self):
         cursor = self._conn.cursor()
@@ -328,11 +624,18 @@ class KeyValueStore:
         for i in range(5):
             json_object[i] = json.loads(json.dumps(json_object))
         print(json_object)
-        for i in range(n):
-            key = random.randint(0, 1000000000000000000)
-            try:
-                self.create(str(key), json_object, ttl)
-            except Exception as e:
-                print(e)
+        items = [(str(random.randint(0, 1000000000000000000)), json_object) for _ in range(n)]
+        try:
+            self.create_many(items, ttl)
+        except Exception as e:
+            print(e)
+
 
+class _ReadConnection:
+    """
+    Holds the read-only connection of one thread
+    sqlite3 connections can't be weakly referenced, but this can
+    """
 
+    def __init__(self, conn):
+        self.conn = conn
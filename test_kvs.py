@@ -4,7 +4,9 @@ import random
 import time
 import threading
 import subprocess
+import sys
 import json
+import math
 from pathlib import Path
 
 
@@ -34,6 +36,145 @@ class TestKVS(unittest.TestCase):
         store.delete(key)
         self.assertRaises(Exception, store.read, key)
 
+    def test_cached_read(self):
+        """
+        Reads a key twice and checks that changing the first returned value doesn't change the second
+        Deletes the key and checks that it can't be read anymore
+        """
+        store = KeyValueStore.open('test')
+        key, value = TestKVS.get_new_key_value(store)
+
+        store.create(key, value)
+        store.read(key)['first_field'] = 'changed'
+        self.assertEqual(value, store.read(key))
+
+        store.delete(key)
+        self.assertRaises(Exception, store.read, key)
+
+    def test_value_serialization(self):
+        """
+        Checks that integers beyond 64 bits and NaN are stored and read back unchanged
+        Checks that the value size limit is measured in UTF-8 bytes
+        """
+        store = KeyValueStore.open('test')
+        big_key, _ = TestKVS.get_new_key_value(store)
+        negative_key, _ = TestKVS.get_new_key_value(store)
+        nan_key, _ = TestKVS.get_new_key_value(store)
+        wide_key, _ = TestKVS.get_new_key_value(store)
+
+        store.create(big_key, {'number': 2 ** 70 + 1})
+        self.assertEqual({'number': 2 ** 70 + 1}, store.read(big_key))
+
+        store.create(negative_key, {'number': -9999999999999999999})
+        self.assertEqual({'number': -9999999999999999999}, store.read(negative_key))
+
+        store.create(nan_key, [float('nan')])
+        self.assertTrue(math.isnan(store.read(nan_key)[0]))
+
+        with self.assertRaises(Exception) as context:
+            store.create(wide_key, {'field': '\u4e2d' * 6000})
+        self.assertEqual(102, context.exception.args[1])
+
+        store.delete(big_key)
+        store.delete(negative_key)
+        store.delete(nan_key)
+
+    def test_key_with_quote(self):
+        """
+        Creates a key containing a single quote
+        Checks that it can be read and deleted like any other key
+        """
+        store = KeyValueStore.open('test')
+        key, value = TestKVS.get_new_key_value(store)
+        key = "it's" + key[:20]
+
+        store.create(key, value)
+        self.assertEqual(value, store.read(key))
+        store.delete(key)
+        self.assertRaises(Exception, store.read, key)
+
+    def test_create_many(self):
+        """
+        Creates some keys in one batch and checks that all of them can be read
+        Then creates a batch containing an existing key and checks that none of its keys are created
+        """
+        store = KeyValueStore.open('test')
+        items = [TestKVS.get_new_key_value(store) for _ in range(10)]
+
+        store.create_many(items)
+        for key, value in items:
+            self.assertEqual(value, store.read(key))
+
+        new_key, new_value = TestKVS.get_new_key_value(store)
+        with self.assertRaises(Exception) as context:
+            store.create_many([(new_key, new_value), items[0]])
+        self.assertEqual(201, context.exception.args[1])
+        self.assertRaises(Exception, store.read, new_key)
+
+        for key, value in items:
+            store.delete(key)
+
+    def test_create_many_size_limit(self):
+        """
+        Lowers the size limit to 1 MB above the current size of the database
+        Creates a batch of about 4 MB and checks that it is rejected as a whole
+        """
+        store = KeyValueStore.open('test')
+        items = []
+        for _ in range(500):
+            key, value = TestKVS.get_new_key_value(store)
+            items.append((key, {'field': 'x' * 8000}))
+
+        db_size_limit = KeyValueStore._DB_SIZE_LIMIT
+        KeyValueStore._DB_SIZE_LIMIT = store._db_size() + 1024 * 1024
+        try:
+            with self.assertRaises(Exception) as context:
+                store.create_many(items)
+        finally:
+            KeyValueStore._DB_SIZE_LIMIT = db_size_limit
+        self.assertEqual(103, context.exception.args[1])
+        self.assertRaises(Exception, store.read, items[0][0])
+
+    def test_read_during_failed_create_many(self):
+        """
+        Keeps reading the keys of a batch in another thread while the batch fails because one key already exists
+        Checks that none of the keys of the failed batch can be read, neither meanwhile nor afterwards
+        """
+        store = KeyValueStore.open('test')
+        existing_key, existing_value = TestKVS.get_new_key_value(store)
+        store.create(existing_key, existing_value)
+        items = [TestKVS.get_new_key_value(store) for _ in range(200)]
+        batch_keys = [key for key, value in items]
+
+        done = threading.Event()
+        successful_reads = []
+        exceptions = []
+
+        def keep_reading():
+            while not done.is_set():
+                for key in batch_keys:
+                    try:
+                        store.read(key)
+                        successful_reads.append(key)
+                    except Exception as e:
+                        exceptions.append(e)
+
+        read_thread = threading.Thread(target=keep_reading)
+        read_thread.start()
+        try:
+            for _ in range(300):
+                self.assertRaises(Exception, store.create_many, items + [(existing_key, existing_value)])
+        finally:
+            done.set()
+            read_thread.join()
+
+        self.assertEqual([], successful_reads)
+        for e in exceptions:
+            self.assertEqual(202, e.args[1] if len(e.args) > 1 else e)
+        for key in batch_keys:
+            self.assertRaises(Exception, store.read, key)
+        store.delete(existing_key)
+
     def test_ttl_read(self):
         """
         Creates a key with ttl = 1
@@ -83,12 +224,35 @@ class TestKVS(unittest.TestCase):
         print('Testing another process access on same file')
         store = KeyValueStore.open('test')
 
-        output = subprocess.check_output("python another_process_for_testing.py", shell=True).decode('utf-8')
+        output = subprocess.check_output([sys.executable, 'another_process_for_testing.py']).decode('utf-8')
         print('Other process said: ' + output)
 
         # Assert that the exception code is as expected
         self.assertEqual(100, int(json.loads(output)['Exception code']))
 
+    def test_same_file_different_paths(self):
+        """
+        Opens the same data store through two different paths
+        Checks that both return the same object
+        """
+        store = KeyValueStore.open('test')
+        self.assertIs(store, KeyValueStore.open('./test'))
+
+    def test_close(self):
+        """
+        Creates a key and closes the data store
+        Opens the data store again and checks that a new object is returned which can read the key
+        """
+        store = KeyValueStore.open('test')
+        key, value = TestKVS.get_new_key_value(store)
+        store.create(key, value)
+        store.close()
+
+        reopened_store = KeyValueStore.open('test')
+        self.assertIsNot(store, reopened_store)
+        self.assertEqual(value, reopened_store.read(key))
+        reopened_store.delete(key)
+
     def test_file_size_limit(self):
         """
         Keeps inserting new keys into the database until the database reaches its limit